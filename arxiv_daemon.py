@@ -2,16 +2,29 @@
 This script is intended to wake up every 30 min or so (eg via cron),
 it checks for any new arxiv papers via the arxiv API and stashes
 them into a sqlite database.
+
+By default it syncs incrementally: a cursor in dict.db remembers up to which
+update time we have seen the papers, and each run only queries the window of
+papers updated since then, oldest first. The cursor is advanced after every
+page, so an interrupted run (or a backfill that needs more than --num papers)
+picks up where it stopped the next time.
+
+On an empty database the first run only walks the latest --num papers, as the
+legacy mode does, and the cursor starts from the newest of them on the next run.
+Syncing the full history of the category instead is opt-in with --backfill.
 """
 
 import sys
 import time
 import random
+import calendar
 import logging
 import argparse
 
-from aslite.arxiv import get_response, parse_response
-from aslite.db import get_papers_db, get_metas_db
+from aslite.arxiv import get_response, parse_response, parse_total_results, date_range_query
+from aslite.db import get_papers_db, get_metas_db, get_sync_db, get_sync_runs_db
+from aslite.db import save_suggest_index, suggest_index_version
+from aslite.suggest import build_suggest_index
 
 if __name__ == '__main__':
 
@@ -19,8 +32,11 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Arxiv Daemon')
     parser.add_argument('-n', '--num', type=int, default=100, help='up to how many papers to fetch')
-    parser.add_argument('-s', '--start', type=int, default=0, help='start at what index')
-    parser.add_argument('-b', '--break-after', type=int, default=3, help='how many 0 new papers in a row would cause us to stop early? or 0 to disable.')
+    parser.add_argument('-s', '--start', type=int, default=0, help='start at what index (only when walking the latest papers, see --no-cursor)')
+    parser.add_argument('-b', '--break-after', type=int, default=3, help='how many 0 new papers in a row would cause us to stop early? or 0 to disable. (only when walking the latest papers)')
+    parser.add_argument('--no-cursor', action='store_true', help='ignore the sync cursor and walk the latest papers from --start instead')
+    parser.add_argument('--overlap', type=float, default=2.0, help='days to re-query before the cursor, papers show up in the api a while after their update time')
+    parser.add_argument('--backfill', action='store_true', help='on an empty database, sync the full history of the category rather than the latest --num papers')
     args = parser.parse_args()
     print(args)
     """
@@ -40,31 +56,51 @@ if __name__ == '__main__':
         pdb[p['_id']] = p
         mdb[p['_id']] = {'_time': p['_time']}
 
-    # fetch the latest papers
-    total_updated = 0
-    zero_updates_in_a_row = 0
-    for k in range(args.start, args.start + args.num, 100):
-        logging.info('querying arxiv api for query %s at start_index %d' % (q, k))
-
-        # attempt to fetch a batch of papers from arxiv api
+    def fetch(query, k, sort_order, accept):
+        """ fetches a page of papers, trying again until accept(papers, total) agrees with it """
+        logging.info('querying arxiv api for query %s at start_index %d' % (query, k))
         ntried = 0
         while True:
             try:
-                resp = get_response(search_query=q, start_index=k)
+                resp = get_response(search_query=query, start_index=k, sort_order=sort_order)
                 papers = parse_response(resp)
+                total = parse_total_results(resp)
                 time.sleep(0.5)
-                if len(papers) == 100:
-                    break # otherwise we have to try again
+                if accept(papers, total):
+                    return papers, total # otherwise we have to try again
             except Exception as e:
                 logging.warning(e)
-                logging.warning("will try again in a bit...")
-                ntried += 1
-                if ntried > 1000:
-                    logging.error("ok we tried 1,000 times, something is srsly wrong. exitting.")
-                    sys.exit()
-                time.sleep(2 + random.uniform(0, 4))
-
-        # process the batch of retrieved papers
+            logging.warning("will try again in a bit...")
+            ntried += 1
+            if ntried > 1000:
+                logging.error("ok we tried 1,000 times, something is srsly wrong. exitting.")
+                sys.exit()
+            time.sleep(2 + random.uniform(0, 4))
+
+    # the sync cursor (see below), or None to walk the latest papers instead
+    cursor = None
+    if not args.no_cursor:
+        sdb = get_sync_db(flag='c')
+        cursor = sdb.get(q, None)
+        if cursor is None:
+            # first incremental run: start from the newest arxiv paper we already have, if any.
+            # metas store mktime() of the utc update time, so undo that to get back utc epoch
+            times = [v['_time'] for pid, v in mdb.items() if '/' not in pid] # skip doi/url pids of other sources
+            if times or args.backfill:
+                since = calendar.timegm(time.localtime(max(times))) if times else None
+                cursor = {'since': since, 'complete': True}
+            else:
+                # a cursor from scratch would walk the whole category since 1970. the next run
+                # starts the cursor from the newest of the papers we fetch now instead
+                logging.info("no arxiv papers yet, fetching the latest %d (use --backfill to sync the full history)" % (args.num, ))
+                sdb.close()
+
+    # stats of this run, recorded in dict.db at the end
+    stats = {'start': int(time.time()), 'mode': 'legacy' if cursor is None else 'cursor',
+             'pages': 0, 'had': 0, 'new': 0, 'replaced': 0, 'complete': True}
+
+    def process(papers, k):
+        """ stores the new and updated papers of a batch, returns how many were new """
         nhad, nnew, nreplace = 0, 0, 0
         for p in papers:
             pid = p['_id']
@@ -81,27 +117,105 @@ if __name__ == '__main__':
                 store(p)
                 nnew += 1
         prevn = len(pdb)
-        total_updated += nreplace + nnew
+        stats['pages'] += 1
+        stats['had'] += nhad
+        stats['new'] += nnew
+        stats['replaced'] += nreplace
 
         # some diagnostic information on how things are coming along
         logging.info(papers[0]['_time_str'])
         logging.info("k=%d, out of %d: had %d, replaced %d, new %d. now have: %d" %
              (k, len(papers), nhad, nreplace, nnew, prevn))
+        return nnew
 
-        # early termination criteria
-        if nnew == 0:
-            zero_updates_in_a_row += 1
-            if args.break_after > 0 and zero_updates_in_a_row >= args.break_after:
-                logging.info("breaking out early, no new papers %d times in a row" % (args.break_after, ))
-                break
-            elif k == 0:
-                logging.info("our very first call for the latest there were no new papers, exitting")
+    if cursor is None:
+        # fetch the latest papers
+        zero_updates_in_a_row = 0
+        for k in range(args.start, args.start + args.num, 100):
+
+            # attempt to fetch a batch of papers from arxiv api
+            papers, _ = fetch(q, k, 'descending', lambda papers, total: len(papers) == 100)
+            nnew = process(papers, k)
+
+            # early termination criteria
+            if nnew == 0:
+                zero_updates_in_a_row += 1
+                if args.break_after > 0 and zero_updates_in_a_row >= args.break_after:
+                    logging.info("breaking out early, no new papers %d times in a row" % (args.break_after, ))
+                    break
+                elif k == 0:
+                    logging.info("our very first call for the latest there were no new papers, exitting")
+                    break
+            else:
+                zero_updates_in_a_row = 0
+
+            # zzz
+            time.sleep(1 + random.uniform(0, 3))
+
+    else:
+        """
+        The cursor is the newest update time up to which we have stored all papers. Each run
+        queries the window [cursor - overlap, now] oldest first, and moves the cursor forward
+        after every page. An interrupted run (or one that hit --num) resumes from that update
+        time rather than from a position in the window: positions shift whenever an earlier
+        paper gets a new version, so resuming at an old offset would skip papers for good.
+        The papers re-fetched this way are simply counted as had/replaced by process().
+        """
+        # the overlap is only needed when opening a new window. a run that resumes an incomplete
+        # one starts right at the cursor, or a small --num could never get past the overlap
+        overlap = args.overlap*60*60*24 if cursor.get('complete', True) else 0
+        since = cursor['since'] - overlap if cursor['since'] is not None else 0
+        query = date_range_query(q, since, int(time.time()))
+        logging.info("syncing papers updated since %s" % (time.strftime('%b %d %Y %H:%M', time.gmtime(since)), ))
+
+        since0 = cursor['since']
+        k = 0
+        total = None
+        while k < args.num:
+            # a page is complete when it holds all remaining results of the window. a total of 0
+            # after we saw results before is a hiccup of the api rather than an emptied window
+            accept = lambda papers, ptotal: len(papers) == max(0, min(100, ptotal - k)) and (ptotal > 0 or not total)
+            papers, total = fetch(query, k, 'ascending', accept)
+            if not papers:
+                break # the window is complete
+
+            process(papers, k)
+            k += len(papers)
+
+            # checkpoint after every page. the api only has minute granularity and the range is
+            # inclusive, so papers sharing the newest update time with the next page are re-fetched
+            newest = max(calendar.timegm(p['updated_parsed']) for p in papers)
+            cursor.update(since=max(cursor['since'] or 0, newest), complete=False)
+            sdb[q] = cursor
+            if k >= total:
                 break
+
+            # zzz
+            time.sleep(1 + random.uniform(0, 3))
+
+        stats['complete'] = total is not None and k >= total
+        cursor['complete'] = stats['complete']
+        sdb[q] = cursor
+        if stats['complete']:
+            logging.info("window complete, the next run continues from the newest paper we saw")
         else:
-            zero_updates_in_a_row = 0
+            logging.info("stopped after %d of %s papers in the window, the next run resumes from the newest paper we saw" % (k, total))
+            if cursor['since'] == since0:
+                logging.warning("the cursor did not advance, more than --num papers share its update time, try a larger --num")
+        sdb.close()
+
+    total_updated = stats['new'] + stats['replaced']
+
+    # refresh the typeahead index of the server if anything changed
+    if total_updated > 0 or suggest_index_version() is None:
+        logging.info("rebuilding the suggest index...")
+        save_suggest_index(build_suggest_index(pdb))
 
-        # zzz
-        time.sleep(1 + random.uniform(0, 3))
+    # record the stats of this run for monitoring
+    stats['wall_time'] = time.time() - stats['start']
+    logging.info("run stats: %s" % (stats, ))
+    with get_sync_runs_db(flag='c') as srdb:
+        srdb['%d' % stats['start']] = stats
 
     # exit with OK status if anything at all changed, but if nothing happened then raise 1
     sys.exit(0 if total_updated > 0 else 1)
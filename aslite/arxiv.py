@@ -10,11 +10,11 @@ from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
-def get_response(search_query, start_index=0):
+def get_response(search_query, start_index=0, sort_order='descending'):
     """ pings arxiv.org API to fetch a batch of 100 papers """
     # fetch raw response
     base_url = 'http://export.arxiv.org/api/query?'
-    add_url = 'search_query=%s&sortBy=lastUpdatedDate&start=%d&max_results=100' % (search_query, start_index)
+    add_url = 'search_query=%s&sortBy=lastUpdatedDate&sortOrder=%s&start=%d&max_results=100' % (search_query, sort_order, start_index)
     #add_url = 'search_query=%s&sortBy=submittedDate&start=%d&max_results=100' % (search_query, start_index)
     search_query = base_url + add_url
     logger.debug(f"Searching arxiv for {search_query}")
@@ -67,6 +67,19 @@ def parse_response(response):
 
     return out
 
+def parse_total_results(response):
+    """ the total number of results of the query, over all pages """
+    parse = feedparser.parse(response)
+    return int(parse.feed.get('opensearch_totalresults', 0))
+
+def date_range_query(search_query, since, until):
+    """
+    restricts a search query to papers last updated within [since, until],
+    both given as utc epoch seconds. the api works at minute granularity
+    """
+    fmt = lambda t: time.strftime('%Y%m%d%H%M', time.gmtime(t))
+    return '%s+AND+lastUpdatedDate:[%s+TO+%s]' % (search_query, fmt(since), fmt(until))
+
 def filter_latest_version(idvs):
     """
     for each idv filter the list down to only the most recent version
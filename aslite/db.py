@@ -5,7 +5,10 @@ Any of the file system I/O and the associated settings are in this single file.
 """
 
 import os
+import time
+import shutil
 import sqlite3, zlib, pickle, tempfile
+import numpy as np
 from sqlitedict import SqliteDict
 from contextlib import contextmanager
 
@@ -77,6 +80,43 @@ def safe_pickle_dump(obj, fname):
     with open_atomic(fname, 'wb') as f:
         pickle.dump(obj, f, -1) # -1 specifies highest binary protocol
 
+# -----------------------------------------------------------------------------
+# utilities for safe writing of a set of .npy arrays that get memory-mapped together
+
+def save_versioned_arrays(dirname, arrays, keep=2):
+    """
+    writes the arrays into a new versioned subdirectory of dirname and then publishes it
+    by atomically rewriting the CURRENT file, so that readers never memory-map a mix of
+    old and half-written arrays. only the last few versions are kept.
+    """
+    version = '%d' % (time.time() * 1000, )
+    vdir = os.path.join(dirname, version)
+    os.makedirs(vdir, exist_ok=True)
+    for name, arr in arrays.items():
+        with open(os.path.join(vdir, name + '.npy'), 'wb') as f:
+            np.save(f, arr)
+    with open_atomic(os.path.join(dirname, 'CURRENT'), 'w') as f:
+        f.write(version)
+
+    # old versions may still be memory-mapped by running processes, which is fine on posix
+    versions = sorted(v for v in os.listdir(dirname) if v.isdigit())
+    for v in versions[:-keep]:
+        shutil.rmtree(os.path.join(dirname, v), ignore_errors=True)
+
+def current_version(dirname):
+    """ the current version of the arrays in dirname, or None if they were never written """
+    path = os.path.join(dirname, 'CURRENT')
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+def load_versioned_arrays(dirname, version):
+    """ loads the arrays of the given version, memory-mapped read-only """
+    vdir = os.path.join(dirname, version)
+    return {fname[:-4]: np.load(os.path.join(vdir, fname), mmap_mode='r')
+            for fname in os.listdir(vdir) if fname.endswith('.npy')}
+
 # -----------------------------------------------------------------------------
 
 class CompressedSqliteDict(SqliteDict):
@@ -129,6 +169,30 @@ def get_email_db(flag='r', autocommit=True):
     edb = SqliteDict(DICT_DB_FILE, tablename='email', flag=flag, autocommit=autocommit)
     return edb
 
+def get_sync_db(flag='r', autocommit=True):
+    """ the sync cursor of arxiv_daemon.py per query, so each run only fetches what changed """
+    assert flag in ['r', 'c']
+    sdb = SqliteDict(DICT_DB_FILE, tablename='sync', flag=flag, autocommit=autocommit)
+    return sdb
+
+def get_sync_runs_db(flag='r', autocommit=True):
+    """ stats of every arxiv_daemon.py run, for monitoring """
+    assert flag in ['r', 'c']
+    srdb = SqliteDict(DICT_DB_FILE, tablename='sync_runs', flag=flag, autocommit=autocommit)
+    return srdb
+
+def get_imports_db(flag='r', autocommit=True):
+    """ checkpoints of the import_venues.py importer, per imported file """
+    assert flag in ['r', 'c']
+    idb = SqliteDict(DICT_DB_FILE, tablename='imports', flag=flag, autocommit=autocommit)
+    return idb
+
+def get_recs_db(flag='r', autocommit=True):
+    """ precomputed recommendations per user, written by the offline recommend.py job """
+    assert flag in ['r', 'c']
+    rdb = CompressedSqliteDict(DICT_DB_FILE, tablename='recs', flag=flag, autocommit=autocommit)
+    return rdb
+
 # -----------------------------------------------------------------------------
 """
 our "feature store" is currently just a pickle file, may want to consider hdf5 in the future
@@ -136,13 +200,111 @@ our "feature store" is currently just a pickle file, may want to consider hdf5 i
 
 # stores tfidf features a bunch of other metadata
 FEATURES_FILE = os.path.join(DATA_DIR, 'features.p')
+# stores a raw copy of the (csr) tfidf matrix that many processes can memory-map at once
+FEATURES_MMAP_DIR = os.path.join(DATA_DIR, 'features_mmap')
 
 def save_features(features):
     """ takes the features dict and save it to disk in a simple pickle file """
     safe_pickle_dump(features, FEATURES_FILE)
 
+def save_features_mmap(features):
+    """
+    writes the csr arrays of the tfidf matrix and the pids as a new version of plain .npy files.
+    only recommend.py needs these, so it exports them itself (see features_mmap_stale)
+    """
+    x = features['x'].tocsr()
+    arrays = {
+        # float64 because that is what sklearn casts to, a float32 memmap would get copied by every fit
+        'data': x.data.astype(np.float64),
+        'indices': x.indices,
+        'indptr': x.indptr,
+        'shape': np.array(x.shape, dtype=np.int64),
+        'pids': np.array(features['pids'], dtype=str),
+    }
+    save_versioned_arrays(FEATURES_MMAP_DIR, arrays)
+
+def features_mtime():
+    """ modification time of the features dict on disk, or None if there is none """
+    return os.path.getmtime(FEATURES_FILE) if os.path.isfile(FEATURES_FILE) else None
+
 def load_features():
     """ loads the features dict from disk """
     with open(FEATURES_FILE, 'rb') as f:
         features = pickle.load(f)
     return features
+
+def features_mmap_stale():
+    """ True if the memory-mapped features are missing or older than the features dict """
+    version = features_mmap_version()
+    if version is None:
+        return True
+    mtime = features_mtime()
+    return mtime is not None and mtime > int(version) / 1000 # versions are ms timestamps
+
+def features_mmap_version():
+    """ the current version of the memory-mapped features, or None if they were never exported """
+    return current_version(FEATURES_MMAP_DIR)
+
+def load_features_mmap(version=None):
+    """
+    loads the tfidf matrix as a csr matrix whose arrays are memory-mapped read-only,
+    so that the processes of a pool read the same pages instead of unpickling their own copy.
+    returns the matrix and the list of pids of the given version, or of the current one.
+    raises FileNotFoundError if not exported yet.
+    """
+    from scipy.sparse import csr_matrix
+    version = version or features_mmap_version()
+    if version is None:
+        raise FileNotFoundError("no memory-mapped features in %s" % (FEATURES_MMAP_DIR, ))
+    a = load_versioned_arrays(FEATURES_MMAP_DIR, version)
+    shape = tuple(int(v) for v in a['shape'])
+    x = csr_matrix((a['data'], a['indices'], a['indptr']), shape=shape, copy=False)
+    pids = np.asarray(a['pids']).tolist()
+    return x, pids
+
+# -----------------------------------------------------------------------------
+"""
+optional low-rank dense embeddings of the papers, stored as plain .npy files (written with
+save_versioned_arrays) so that they can be memory-mapped as one contiguous array and shared by all server workers
+"""
+
+EMBEDDINGS_DIR = os.path.join(DATA_DIR, 'embeddings')
+
+def save_embeddings(e, pids):
+    """ takes the (n, d) L2-normalised embedding matrix and the pids of its rows and saves them """
+    assert e.shape[0] == len(pids)
+    # one versioned write, so that readers never pair the pids of one run with the matrix of another
+    save_versioned_arrays(EMBEDDINGS_DIR, {'e': np.ascontiguousarray(e), 'pids': np.array(pids, dtype=str)})
+
+def remove_embeddings():
+    """ deletes the embeddings, so they don't outlive the features they were computed from """
+    shutil.rmtree(EMBEDDINGS_DIR, ignore_errors=True)
+
+def embeddings_version():
+    """ the current version of the embeddings, or None if there are none """
+    return current_version(EMBEDDINGS_DIR)
+
+def load_embeddings(version):
+    """ loads the given version of the embedding matrix memory-mapped read-only, and the list of pids of its rows """
+    a = load_versioned_arrays(EMBEDDINGS_DIR, version)
+    return a['e'], np.asarray(a['pids']).tolist()
+
+# -----------------------------------------------------------------------------
+"""
+the typeahead prefix index (see aslite/suggest.py) is a set of .npy arrays, written with
+save_versioned_arrays so that server workers never memory-map a half-written index
+"""
+
+SUGGEST_DIR = os.path.join(DATA_DIR, 'suggest')
+
+def save_suggest_index(index):
+    """ writes a new version of the index arrays and makes it current """
+    save_versioned_arrays(SUGGEST_DIR, index)
+
+def suggest_index_version():
+    """ the current version of the index, or None if it was never built """
+    return current_version(SUGGEST_DIR)
+
+def load_suggest_index(version):
+    """ loads the arrays of the given version of the index, memory-mapped read-only """
+    return load_versioned_arrays(SUGGEST_DIR, version)
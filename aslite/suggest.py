@@ -0,0 +1,105 @@
+"""
+Prefix index over paper titles and author names, powering the typeahead of the search box.
+The index is a handful of flat numpy arrays sorted by a normalised key, so a lookup is
+two binary searches plus a vectorised top-k over the matches, and the arrays can be memory-mapped and shared by all server workers.
+"""
+
+import re
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+KEY_LEN = 64 # keys are truncated to this many bytes, longer queries are truncated as well
+
+TITLE, AUTHOR = 0, 1 # the kinds of entries in the index
+
+def normalize_key(s):
+    """ lowercase ascii with accents stripped and all punctuation collapsed to single spaces """
+    s = unicodedata.normalize('NFKD', s).encode('ascii', 'ignore').decode('ascii')
+    s = re.sub(r'[^a-z0-9]+', ' ', s.lower()).strip()
+    return s.encode('ascii')[:KEY_LEN]
+
+def _pack(strs):
+    """ packs a list of strings into one utf-8 byte blob and an array of offsets into it """
+    bufs = [s.encode('utf-8') for s in strs]
+    offsets = np.zeros(len(bufs) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in bufs], out=offsets[1:])
+    blob = np.frombuffer(b''.join(bufs), dtype=np.uint8)
+    return blob, offsets
+
+def build_suggest_index(pdb):
+    """
+    builds the index from the papers database. Every title gets an entry weighted by
+    its time (newer first), every author gets an entry for the full name and one for
+    the last name, weighted by their number of papers.
+    """
+    entries = [] # (key, kind, weight, text, pid)
+    author_counts = Counter()
+    for pid, d in pdb.items():
+        if d.get('title'):
+            title = ' '.join(d['title'].split()) # arxiv titles contain line breaks
+            entries.append((normalize_key(title), TITLE, float(d['_time']), title, pid))
+        for a in d.get('authors') or []:
+            name = a['name'] if isinstance(a, dict) else a
+            if name:
+                author_counts[' '.join(name.split())] += 1
+
+    for name, count in author_counts.items():
+        entries.append((normalize_key(name), AUTHOR, float(count), name, ''))
+        parts = name.split()
+        if len(parts) > 1:
+            entries.append((normalize_key(parts[-1]), AUTHOR, float(count), name, ''))
+
+    entries = [e for e in entries if e[0]]
+    entries.sort(key=lambda e: e[0])
+    texts_blob, texts_offsets = _pack([e[3] for e in entries])
+    pids_blob, pids_offsets = _pack([e[4] for e in entries])
+    return {
+        'keys': np.array([e[0] for e in entries], dtype='S%d' % (KEY_LEN, )),
+        'kinds': np.array([e[1] for e in entries], dtype=np.int8),
+        'weights': np.array([e[2] for e in entries], dtype=np.float64),
+        'texts_blob': texts_blob,
+        'texts_offsets': texts_offsets,
+        'pids_blob': pids_blob,
+        'pids_offsets': pids_offsets,
+    }
+
+def _unpack(index, name, i):
+    blob, offsets = index[name + '_blob'], index[name + '_offsets']
+    return bytes(blob[offsets[i]:offsets[i+1]]).decode('utf-8')
+
+def suggest(index, q, num=8):
+    """ returns the top num title and author completions of the query q """
+    prefix = normalize_key(q)[:KEY_LEN-1] # leave room for the upper bound below
+    if not prefix:
+        return {'titles': [], 'authors': []}
+
+    keys = index['keys']
+    lo = np.searchsorted(keys, prefix, side='left')
+    hi = np.searchsorted(keys, prefix + b'\xff', side='left') # keys are ascii, so this bounds the prefix
+
+    # rank all the matches, not just an alphabetical slice of them, e.g. "so" matches a lot
+    kinds, weights = index['kinds'][lo:hi], index['weights'][lo:hi]
+
+    def top(kind, k):
+        """ positions of the k highest weighted matches of the given kind, best first """
+        w = np.where(kinds == kind, weights, -np.inf)
+        k = min(k, int(np.count_nonzero(kinds == kind)))
+        if k == 0:
+            return []
+        ixs = np.argpartition(-w, k - 1)[:k]
+        return ixs[np.argsort(-w[ixs], kind='stable')]
+
+    titles = [{'pid': _unpack(index, 'pids', lo + ix), 'title': _unpack(index, 'texts', lo + ix)}
+              for ix in top(TITLE, num)]
+
+    # authors can match on both their full and last name, so take twice as many and dedup
+    authors, seen = [], set()
+    for ix in top(AUTHOR, 2 * num):
+        name = _unpack(index, 'texts', lo + ix)
+        if name not in seen and len(authors) < num:
+            seen.add(name)
+            authors.append({'name': name, 'count': int(weights[ix])})
+
+    return {'titles': titles, 'authors': authors}
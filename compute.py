@@ -1,14 +1,134 @@
 """
 Extracts tfidf features from all paper abstracts and saves them to disk.
+Optionally also computes a low-rank dense embedding of the tfidf vectors,
+which serve.py can use for fast similarity ranking.
+
+Two featurization engines are available:
+- tfidf (default): sklearn's TfidfVectorizer, which holds the full vocabulary of
+  all unigrams and bigrams in memory before pruning it to the top features.
+- hashing: hashes terms into a fixed number of buckets and streams the papers in
+  chunks, so the memory used for featurization does not grow with the archive.
 """
 
 import argparse
 from random import shuffle
+from collections import Counter
 
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
+import scipy.sparse as sp
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from sklearn.decomposition import TruncatedSVD
+from sklearn.random_projection import SparseRandomProjection
+from sklearn.preprocessing import normalize
 
-from aslite.db import get_papers_db, save_features
+from aslite.db import get_papers_db, save_features, save_embeddings, remove_embeddings
+
+# -----------------------------------------------------------------------------
+
+# the text preprocessing settings shared by both featurization engines
+TEXT_KWARGS = dict(input='content',
+                   encoding='utf-8', decode_error='replace', strip_accents='unicode',
+                   lowercase=True, analyzer='word', stop_words='english',
+                   token_pattern=r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b',
+                   ngram_range=(1, 2))
+
+def paper_text(d):
+    """ the text of a paper that gets featurized: its title, abstract and authors """
+    # TODO re-create database by first unifying representation of data from all sources then use original code
+    if d['authors'] is not None:
+        author_str = ' '.join([a['name'] if isinstance(a, dict) else a for a in d['authors']])
+
+    else:
+        author_str = ''
+
+    return ' '.join([d['title'] if d['title'] is not None else '', d['summary'] if d['summary'] is not None else '', author_str])
+
+def iter_chunks(pdb, chunk_size):
+    """ streams (pids, texts) chunks of papers out of the papers database """
+    pids, texts = [], []
+    for pid, d in pdb.items():
+        pids.append(pid)
+        texts.append(paper_text(d))
+        if len(pids) == chunk_size:
+            yield pids, texts
+            pids, texts = [], []
+    if pids:
+        yield pids, texts
+
+# number of candidate terms tracked per kept hash bucket, to name it after its most frequent term
+BUCKET_CANDIDATES = 4
+
+def update_bucket_terms(bucket_terms, ix, term, count):
+    """
+    space-saving heavy hitters: keeps at most BUCKET_CANDIDATES (term, count) candidates
+    per bucket. A term that is more frequent than all others together is never evicted,
+    and memory stays bounded by the number of kept buckets rather than by the vocabulary.
+    """
+    cands = bucket_terms.setdefault(ix, {})
+    if term in cands or len(cands) < BUCKET_CANDIDATES:
+        cands[term] = cands.get(term, 0) + count
+    else:
+        evict = min(cands, key=lambda t: (cands[t], t))
+        cands[term] = cands.pop(evict) + count
+
+def hashing_features(pdb, args):
+    """
+    out-of-core equivalent of the TfidfVectorizer pipeline. The first pass counts the
+    document and term frequencies of every hash bucket, which selects the same kind of
+    top features under the min_df/max_df constraints. The second pass transforms the
+    chunks into tfidf rows of the selected buckets, and names every bucket after the
+    most frequent term hashing into it, so that the words can still be displayed. Peak memory is bounded by the number of
+    buckets and the chunk size, plus the (unavoidable) output matrix itself.
+    """
+    analyzer = HashingVectorizer(**TEXT_KWARGS).build_analyzer()
+    # equivalent to HashingVectorizer.transform, but lets us reuse the analyzed tokens
+    hasher = FeatureHasher(n_features=args.hash_features, input_type='string', alternate_sign=False, dtype=np.float32)
+
+    print("counting document frequencies...")
+    df = np.zeros(args.hash_features, dtype=np.int64)
+    tf = np.zeros(args.hash_features, dtype=np.float64)
+    ndocs = 0
+    for _, texts in iter_chunks(pdb, args.chunk_size):
+        c = hasher.transform(analyzer(t) for t in texts).tocsr()
+        df += np.bincount(c.indices, minlength=args.hash_features)
+        tf += np.asarray(c.sum(axis=0)).ravel()
+        ndocs += c.shape[0]
+        print("%d docs" % (ndocs, ))
+
+    # keep the most frequent buckets among those within the df limits, like max_features does
+    keep = (df >= args.min_df) & (df <= args.max_df * ndocs)
+    cand = np.flatnonzero(keep)
+    cols = np.sort(cand[np.argsort(-tf[cand], kind='stable')[:args.num]])
+    colmap = np.full(args.hash_features, -1, dtype=np.int64)
+    colmap[cols] = np.arange(len(cols))
+    idf = (np.log((1 + ndocs) / (1 + df[cols])) + 1).astype(np.float32) # smooth_idf=True
+    print("kept %d of %d hash buckets" % (len(cols), args.hash_features))
+
+    print("running inference...")
+    pids, rows, bucket_terms = [], [], {}
+    for cpids, texts in iter_chunks(pdb, args.chunk_size):
+        tokens = [analyzer(t) for t in texts]
+        c = hasher.transform(tokens).tocsr()[:, cols]
+        np.log(c.data, out=c.data)
+        c.data += 1 # sublinear_tf=True
+        c = normalize(c.multiply(idf).tocsr(), norm='l2')
+        rows.append(c.astype(np.float32))
+        pids.extend(cpids)
+
+        # count the terms of the kept buckets, sorted so that the naming is deterministic
+        counts = Counter(t for toks in tokens for t in toks)
+        terms = sorted(counts)
+        ixs = colmap[hasher.transform([t] for t in terms).tocsr().indices] if terms else []
+        for term, ix in zip(terms, ixs):
+            if ix >= 0:
+                update_bucket_terms(bucket_terms, int(ix), term, counts[term])
+
+    x = sp.vstack(rows, format='csr') if rows else sp.csr_matrix((0, len(cols)), dtype=np.float32)
+    # name every bucket after its most frequent term
+    ivocab = {ix: max(cands, key=lambda t: (cands[t], t)) for ix, cands in bucket_terms.items()}
+    vocab = {ivocab.get(ix, '<bucket %d>' % (cols[ix], )): ix for ix in range(len(cols))}
+    return pids, x, vocab, idf
 
 # -----------------------------------------------------------------------------
 
@@ -18,55 +138,80 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--num', type=int, default=20000, help='number of tfidf features')
     parser.add_argument('--min_df', type=int, default=5, help='min df')
     parser.add_argument('--max_df', type=float, default=0.1, help='max df')
-    parser.add_argument('--max_docs', type=int, default=-1, help='maximum number of documents to use when training tfidf, or -1 to disable')
+    parser.add_argument('--max_docs', type=int, default=-1, help='maximum number of documents to use when training tfidf (tfidf engine only), or -1 to disable')
+    parser.add_argument('--engine', type=str, default='tfidf', choices=['tfidf', 'hashing'], help='featurization engine, hashing runs in bounded memory')
+    parser.add_argument('--chunk_size', type=int, default=5000, help='hashing engine: number of papers to featurize at a time')
+    parser.add_argument('--hash_features', type=int, default=2**20, help='hashing engine: number of hash buckets, to pick the features from')
+    parser.add_argument('--embed_dim', type=int, default=0, help='dimensionality of the dense embeddings (e.g. 128 or 256), or 0 to disable')
+    parser.add_argument('--embed_method', type=str, default='svd', choices=['svd', 'rp'], help='truncated svd, or the cheaper sparse random projection')
+    parser.add_argument('--embed_dtype', type=str, default='float32', choices=['float32', 'float16'], help='float16 halves the memory, but numpy has no fast BLAS path for it')
     args = parser.parse_args()
     print(args)
 
-    v = TfidfVectorizer(input='content',
-                        encoding='utf-8', decode_error='replace', strip_accents='unicode',
-                        lowercase=True, analyzer='word', stop_words='english',
-                        token_pattern=r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b',
-                        ngram_range=(1, 2), max_features=args.num,
-                        norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=True,
-                        max_df=args.max_df, min_df=args.min_df)
-
     pdb = get_papers_db(flag='r')
 
-    def make_corpus(training: bool):
-        assert isinstance(training, bool)
+    if args.engine == 'hashing':
+        pids, x, vocab, idf = hashing_features(pdb, args)
+        print(x.shape)
 
-        # determine which papers we will use to build tfidf
-        if training and args.max_docs > 0 and args.max_docs < len(pdb):
-            # crop to a random subset of papers
-            keys = list(pdb.keys())
-            shuffle(keys)
-            keys = keys[:args.max_docs]
-        else:
-            keys = pdb.keys()
+        print("saving to features to disk...")
+        features = {
+            'pids': pids,
+            'x': x,
+            'vocab': vocab,
+            'idf': idf,
+        }
+        save_features(features)
+
+    else:
+        v = TfidfVectorizer(**TEXT_KWARGS, max_features=args.num,
+                            norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=True,
+                            max_df=args.max_df, min_df=args.min_df)
 
-        # yield the abstracts of the papers
-        for p in keys:
-            d = pdb[p]
-            # TODO re-create database by first unifying representation of data from all sources then use original code
-            if d['authors'] is not None:
-                author_str = ' '.join([a['name'] if isinstance(a, dict) else a for a in d['authors']])
+        def make_corpus(training: bool):
+            assert isinstance(training, bool)
 
+            # determine which papers we will use to build tfidf
+            if training and args.max_docs > 0 and args.max_docs < len(pdb):
+                # crop to a random subset of papers
+                keys = list(pdb.keys())
+                shuffle(keys)
+                keys = keys[:args.max_docs]
             else:
-                author_str = ''
-            
-            yield ' '.join([d['title'] if d['title'] is not None else '', d['summary'] if d['summary'] is not None else '', author_str])                                                      
-    print("training tfidf vectors...")
-    v.fit(make_corpus(training=True))
+                keys = pdb.keys()
 
-    print("running inference...")
-    x = v.transform(make_corpus(training=False)).astype(np.float32)
-    print(x.shape)
-
-    print("saving to features to disk...")
-    features = {
-        'pids': list(pdb.keys()),
-        'x': x,
-        'vocab': v.vocabulary_,
-        'idf': v._tfidf.idf_,
-    }
-    save_features(features)
+            # yield the abstracts of the papers
+            for p in keys:
+                yield paper_text(pdb[p])
+
+        print("training tfidf vectors...")
+        v.fit(make_corpus(training=True))
+
+        print("running inference...")
+        x = v.transform(make_corpus(training=False)).astype(np.float32)
+        print(x.shape)
+
+        print("saving to features to disk...")
+        features = {
+            'pids': list(pdb.keys()),
+            'x': x,
+            'vocab': v.vocabulary_,
+            'idf': v._tfidf.idf_,
+        }
+        save_features(features)
+
+    if args.embed_dim > 0:
+        print("computing %d-dimensional %s embeddings..." % (args.embed_dim, args.embed_method))
+        if args.embed_method == 'svd':
+            reducer = TruncatedSVD(n_components=args.embed_dim, algorithm='randomized', random_state=0)
+        else:
+            reducer = SparseRandomProjection(n_components=args.embed_dim, dense_output=True, random_state=0)
+        e = reducer.fit_transform(x)
+        e = normalize(e, norm='l2').astype(args.embed_dtype) # so that dot products are cosine similarities
+        print(e.shape)
+
+        print("saving embeddings to disk...")
+        save_embeddings(e, features['pids'])
+    else:
+        # embeddings of an earlier run would no longer match the features, so drop them (sim then returns nothing)
+        remove_embeddings()
@@ -0,0 +1,305 @@
+"""
+Imports published papers from external datasets of SE venues (e.g. ZeinabAk/DatasetSEVenues)
+into the papers database, in the same representation that arxiv_daemon.py stores.
+
+The input is a CSV or JSONL dump, which is streamed in chunks. Chunks are normalised by a pool
+of worker processes, deduplicated against the papers we already have (by pid and by DOI), and
+committed to papers and then to metas (two separate transactions) once per chunk. Progress is
+checkpointed (as a byte position in the file) after every chunk, so an interrupted import
+seeks right to where it stopped when run again with the same file, and papers left without
+metas by a crash are repaired on startup.
+"""
+
+import os
+import re
+import csv
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+
+from aslite.db import get_papers_db, get_metas_db, get_imports_db, save_suggest_index
+from aslite.suggest import build_suggest_index
+
+# -----------------------------------------------------------------------------
+# normalisation of the raw records, runs in the worker processes
+
+# the columns we look for in the dumps, in order of preference
+FIELDS = {
+    'doi': ['doi'],
+    'url': ['url', 'link', 'ee'],
+    'title': ['title'],
+    'summary': ['abstract', 'summary'],
+    'authors': ['authors', 'author'],
+    'date': ['date', 'published', 'year'],
+    'venue': ['venue', 'booktitle', 'journal', 'conference'],
+}
+
+def get_field(r, name):
+    for k in FIELDS[name]:
+        v = r.get(k)
+        if v not in (None, ''):
+            return v
+    return None
+
+def clean_str(s):
+    return ' '.join(str(s).split()) if s is not None else ''
+
+def parse_doi(s):
+    """ strips the resolver prefix from a doi, e.g. https://doi.org/10.1145/123 -> 10.1145/123 """
+    if not s:
+        return None
+    s = re.sub(r'^(https?://)?(dx\.)?doi\.org/', '', clean_str(s), flags=re.IGNORECASE)
+    return s if s.startswith('10.') else None
+
+# lowercase particles that start a multi-word last name, e.g. "van der Berg, Jan"
+NAME_PARTICLES = {'van', 'von', 'der', 'den', 'de', 'del', 'della', 'di', 'da', 'das', 'dos', 'du', 'la', 'le', 'ter', 'ten'}
+INITIALS = re.compile(r'^(\w\.\s*-?\s*)+$') # e.g. "A.", "A. B.", "J.-P."
+
+def is_last_name(s):
+    """ could s be the Last of a "Last, First" pair: one word, or one led by a particle """
+    words = s.split()
+    return len(words) == 1 or words[0].lower() in NAME_PARTICLES
+
+def is_given_name(s):
+    """ could s be the First of a "Last, First" pair in a list of them: initials or one word """
+    return bool(INITIALS.match(s)) or len(s.split()) == 1
+
+def split_names(s):
+    """
+    splits a comma separated string into names. the pieces are "Last, First" pairs, as in bibtex,
+    when they line up as such, otherwise each piece is a full name ("Alice Smith, Bob Jones").
+    a list that fits neither is kept whole rather than split into fragments like bare initials
+    """
+    pieces = [x for x in (clean_str(x) for x in s.split(',')) if x]
+    lasts, firsts = pieces[::2], pieces[1::2]
+    if len(pieces) == 2 and is_last_name(pieces[0]):
+        return [pieces[1] + ' ' + pieces[0]] # a single pair, the given names can be several words
+    if len(pieces) % 2 == 0 and all(map(is_last_name, lasts)) and all(map(is_given_name, firsts)):
+        return [first + ' ' + last for last, first in zip(lasts, firsts)]
+    if any(INITIALS.match(x) for x in pieces):
+        return [clean_str(s)]
+    return pieces
+
+def parse_authors(a):
+    """
+    authors come as lists, or as strings separated by semicolons or pipes, or else by commas
+    and 'and'. bibtex style "Last, First" pairs are recognised as one author each, e.g.
+
+    >>> [n['name'] for n in parse_authors("A B, C D and E F")]
+    ['A B', 'C D', 'E F']
+    >>> [n['name'] for n in parse_authors("van der Berg, Jan and Smith, Alice")]
+    ['Jan van der Berg', 'Alice Smith']
+    >>> [n['name'] for n in parse_authors("Smith, A., Jones, B.")]
+    ['A. Smith', 'B. Jones']
+    >>> [n['name'] for n in parse_authors("Smith, Alice, Jones, Bob")]
+    ['Alice Smith', 'Bob Jones']
+    >>> [n['name'] for n in parse_authors("Smith, Alice Jane; de Souza, Ana")]
+    ['Alice Jane Smith', 'Ana de Souza']
+    """
+    if a is None:
+        return []
+    if isinstance(a, str):
+        parts = re.split(r'[;|]', a) if re.search(r'[;|]', a) else re.split(r'\s+and\s+', a)
+        a = [name for part in parts for name in split_names(part)]
+    names = [clean_str(n['name'] if isinstance(n, dict) else n) for n in a]
+    return [{'name': n} for n in names if n]
+
+def parse_time(s):
+    """ a year or an iso date, to a struct_time, or None if we can't make sense of it """
+    s = clean_str(s)
+    for fmt in ['%Y-%m-%d', '%Y-%m', '%Y']:
+        try:
+            return time.strptime(s[:len(time.strftime(fmt, time.gmtime(0)))], fmt)
+        except ValueError:
+            pass
+    return None
+
+def normalize_record(r):
+    """ maps one raw record to the arxiv_daemon schema, or returns None if it is unusable """
+    if not isinstance(r, dict):
+        return None # a line of the dump that was not a json object, see read_records
+    r = {str(k).strip().lower(): v for k, v in r.items()}
+    doi = parse_doi(get_field(r, 'doi'))
+    url = clean_str(get_field(r, 'url'))
+    title = clean_str(get_field(r, 'title'))
+    t = parse_time(get_field(r, 'date'))
+    pid = doi or url
+    if not pid or not title or t is None:
+        return None
+
+    return {
+        '_id': pid,
+        '_idv': pid,
+        '_version': 1,
+        '_time': time.mktime(t),
+        '_time_str': time.strftime('%b %d %Y', t),
+        'id': pid,
+        'link': 'https://doi.org/' + doi if doi else url,
+        'doi': doi,
+        'title': title,
+        'summary': clean_str(get_field(r, 'summary')),
+        'authors': parse_authors(get_field(r, 'authors')),
+        'venue': clean_str(get_field(r, 'venue')),
+    }
+
+def normalize_chunk(records):
+    return [normalize_record(r) for r in records]
+
+# -----------------------------------------------------------------------------
+# deduplication
+
+def dedup_key(kind, value):
+    """ a compact 64 bit hash of a normalised identifier, so the index of all papers stays small """
+    h = hashlib.blake2b((kind + ':' + value.strip().lower()).encode('utf-8'), digest_size=8)
+    return int.from_bytes(h.digest(), 'little')
+
+def paper_keys(p):
+    keys = [dedup_key('pid', p['_id'])]
+    doi = p.get('doi') or p.get('arxiv_doi') # arxiv papers sometimes carry the doi of their publication
+    if doi:
+        keys.append(dedup_key('doi', doi))
+    elif p['_id'].startswith('10.'):
+        keys.append(dedup_key('doi', p['_id'])) # papers imported earlier used the doi as their pid
+    return keys
+
+# -----------------------------------------------------------------------------
+
+def read_records(path, pos=0):
+    """
+    streams the raw records (dicts) of a csv or jsonl file, starting at byte position pos,
+    each together with the byte position right after it, from where a later run can resume.
+    a jsonl line that doesn't decode to an object is yielded as None, so it is counted as
+    invalid and skipped
+    """
+    with open(path, 'rb') as f:
+        end = 0 # byte position after the last line handed out by lines()
+
+        def lines():
+            nonlocal end
+            for line in f:
+                end += len(line)
+                yield line.decode('utf-8', errors='replace')
+
+        if path.endswith('.csv'):
+            csv.field_size_limit(sys.maxsize) # abstracts can be long
+            reader = csv.reader(lines()) # pulls exactly the lines of one row at a time
+            header = next(reader, None)
+            if header is None:
+                return
+            if pos > end:
+                f.seek(pos) # past the header, which we read above either way
+                end = pos
+            for row in reader:
+                if row: # skip blank lines, as csv.DictReader does
+                    yield dict(zip(header, row)), end
+        else:
+            f.seek(pos)
+            end = pos
+            for line in lines():
+                if line.strip():
+                    try:
+                        r = json.loads(line)
+                    except ValueError:
+                        r = None
+                    yield (r if isinstance(r, dict) else None), end
+
+def iter_chunks(records, chunk_size):
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO, format='%(name)s %(levelname)s %(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    parser = argparse.ArgumentParser(description='SE Venues Importer')
+    parser.add_argument('path', type=str, help='csv or jsonl file to import')
+    parser.add_argument('-c', '--chunk_size', type=int, default=2000, help='number of records per chunk and transaction')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='number of normalisation worker processes')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and import the file from the start')
+    args = parser.parse_args()
+    print(args)
+
+    ckey = os.path.abspath(args.path)
+    with get_imports_db(flag='c') as idb:
+        ckpt = idb.get(ckey, None) if not args.restart else None
+    ckpt = ckpt or {'offset': 0, 'pos': 0, 'imported': 0, 'duplicate': 0, 'invalid': 0}
+    if ckpt['offset'] > 0:
+        logging.info("resuming from record %d of %s" % (ckpt['offset'], args.path))
+
+    pdb = get_papers_db(flag='c', autocommit=False)
+    mdb = get_metas_db(flag='c', autocommit=False)
+
+    logging.info("indexing the papers we already have...")
+    seen = set()
+    metas_pids = set(mdb.keys())
+    nrepaired = 0
+    for pid, p in pdb.items():
+        seen.update(paper_keys(p))
+        if pid not in metas_pids:
+            # papers and metas are committed separately, so an earlier crash in between
+            # can leave papers without metas, which time_rank and the time filter rely on
+            mdb[pid] = {'_time': p['_time']}
+            nrepaired += 1
+    mdb.commit()
+    logging.info("%d keys for %d papers, repaired %d missing metas" % (len(seen), len(pdb), nrepaired))
+
+    t0, offset0, nimported = time.time(), ckpt['offset'], 0
+    if 'pos' in ckpt:
+        records = read_records(args.path, ckpt['pos']) # seek right past the records we already did
+    else:
+        records = islice(read_records(args.path), ckpt['offset'], None) # checkpoints of older versions
+    chunks = iter_chunks(records, args.chunk_size)
+    with Pool(args.workers) as pool:
+        # keep a bounded number of chunks in flight, results are consumed in file order
+        pending = deque()
+        while True:
+            for chunk in islice(chunks, 2 * args.workers - len(pending)):
+                raw = [r for r, _ in chunk]
+                pending.append((len(chunk), chunk[-1][1], pool.apply_async(normalize_chunk, (raw, ))))
+            if not pending:
+                break
+            nrecords, pos, result = pending.popleft()
+
+            for p in result.get():
+                if p is None:
+                    ckpt['invalid'] += 1
+                    continue
+                keys = paper_keys(p)
+                if any(k in seen for k in keys):
+                    ckpt['duplicate'] += 1
+                    continue
+                seen.update(keys)
+                pdb[p['_id']] = p
+                mdb[p['_id']] = {'_time': p['_time']}
+                ckpt['imported'] += 1
+                nimported += 1
+            # papers first: a crash before the metas commit is repaired on the next run (see above)
+            pdb.commit()
+            mdb.commit()
+
+            # a crash between the commits above and the checkpoint only redoes this chunk,
+            # and the redone papers are then skipped as duplicates
+            ckpt['offset'] += nrecords
+            ckpt['pos'] = pos
+            ckpt['time'] = int(time.time())
+            with get_imports_db(flag='c') as idb:
+                idb[ckey] = ckpt
+            logging.info("%d records: imported %d, duplicate %d, invalid %d (%.0f records/s)" %
+                         (ckpt['offset'], ckpt['imported'], ckpt['duplicate'], ckpt['invalid'],
+                          (ckpt['offset'] - offset0) / max(time.time() - t0, 1e-3)))
+
+    if nimported > 0:
+        logging.info("rebuilding the suggest index...")
+        save_suggest_index(build_suggest_index(pdb))
+
+    pdb.close()
+    mdb.close()
@@ -0,0 +1,151 @@
+"""
+Offline batch job that precomputes paper recommendations for recently active users.
+Intended to be run periodically (eg via cron, after compute.py), so that the heavy
+svm training happens in the background and only for users that actually visit the
+site. The top results are written to the recs table, which serve.py reads directly.
+
+The job is resumable: recommendations are stored per user as soon as they are done,
+and users whose recommendations are fresh enough are skipped on the next run.
+
+NOTE: this fork currently has no login and no tag routes (they are commented out in
+serve.py), so there are never any active users with tags and the job exits right away
+with "no users active". It is kept, together with rank=recommend, for when accounts
+and tags come back; until then running it does nothing.
+"""
+
+import sys
+import time
+import logging
+import argparse
+from multiprocessing import Process, Pipe
+
+import numpy as np
+from sklearn import svm
+
+from aslite.db import get_last_active_db, get_tags_db, get_recs_db
+from aslite.db import load_features, save_features_mmap, load_features_mmap
+from aslite.db import features_mmap_stale, features_mmap_version
+
+# -----------------------------------------------------------------------------
+
+def train_user(conn, version, pos, num, C):
+    """
+    runs in a child process: fits an svm with the given positive indices and sends
+    back the indices and scores of the top num papers through the pipe. version pins
+    the memory-mapped features, so the indices refer to the pids the parent loaded
+    """
+    # the feature arrays are memory-mapped (and stored as the float64 that sklearn wants, so
+    # fit doesn't cast a private copy), but note liblinear still builds its own internal copy
+    x, _ = load_features_mmap(version)
+    n = x.shape[0]
+    y = np.zeros(n, dtype=np.float32)
+    y[pos] = 1.0
+
+    clf = svm.LinearSVC(class_weight='balanced', verbose=False, max_iter=10000, tol=1e-6, C=C)
+    clf.fit(x, y)
+    s = clf.decision_function(x)
+    s[pos] = -np.inf # don't recommend papers the user already has
+
+    num = min(num, n - len(pos))
+    top = np.argpartition(-s, num - 1)[:num] if num > 0 else np.zeros(0, dtype=np.int64)
+    top = top[np.argsort(-s[top])]
+    conn.send((top.astype(np.int32), s[top].astype(np.float32)))
+    conn.close()
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO, format='%(name)s %(levelname)s %(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    parser = argparse.ArgumentParser(description='Arxiv Recommender')
+    parser.add_argument('-d', '--days', type=float, default=7.0, help='only compute recommendations for users active in the last this many days')
+    parser.add_argument('-n', '--num', type=int, default=100, help='number of recommendations to store per user')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='number of users to train in parallel')
+    parser.add_argument('-t', '--budget', type=float, default=60.0, help='seconds of training allowed per user before giving up on them')
+    parser.add_argument('-r', '--refresh', type=float, default=12.0, help='skip users whose recommendations are younger than this many hours')
+    parser.add_argument('--svm_c', type=float, default=0.01, help='svm C parameter')
+    args = parser.parse_args()
+    print(args)
+
+    # determine the users that were active recently, the tables are opened with 'c' because they don't exist until someone has logged in
+    tnow = time.time()
+    with get_last_active_db(flag='c') as last_active_db:
+        active = {u: t for u, t in last_active_db.items() if tnow - t < args.days*60*60*24}
+    if not active:
+        logging.info("no users active in the last %.1f days, nothing to do" % (args.days, ))
+        sys.exit(0)
+
+    # compute.py only writes the features pickle, export a memory-mapped copy of it if ours is missing or older
+    if features_mmap_stale():
+        logging.info("memory-mapped features missing or out of date, exporting them from the features pickle...")
+        save_features_mmap(load_features())
+    # resolve the version once, the children load exactly this one even if a newer one appears meanwhile
+    version = features_mmap_version()
+    _, pids = load_features_mmap(version)
+    ptoi = {p: i for i, p in enumerate(pids)}
+
+    # skip the users whose recommendations are still fresh, and those without any tags
+    with get_recs_db(flag='c') as recs_db:
+        fresh = {u for u in active if u in recs_db and tnow - recs_db[u]['time'] < args.refresh*60*60}
+    with get_tags_db(flag='c') as tags_db:
+        todo = []
+        for user in sorted(active, key=active.get, reverse=True): # most recently active first
+            if user in fresh or user not in tags_db:
+                continue
+            tagged = set().union(*tags_db[user].values())
+            pos = sorted(ptoi[p] for p in tagged if p in ptoi)
+            if pos:
+                todo.append((user, pos))
+    logging.info("%d users active in the last %.1f days, %d already fresh, %d to compute" %
+                 (len(active), args.days, len(fresh), len(todo)))
+
+    # train the users in a bounded set of child processes, each with its own time budget
+    rdb = get_recs_db(flag='c')
+    running = {} # user -> (process, connection, start time)
+    ndone, nfailed = 0, 0
+    while todo or running:
+        while todo and len(running) < args.workers:
+            user, pos = todo.pop(0)
+            recv_conn, send_conn = Pipe(duplex=False)
+            p = Process(target=train_user, args=(send_conn, version, pos, args.num, args.svm_c), daemon=True)
+            p.start()
+            send_conn.close() # only the child writes into the pipe
+            running[user] = (p, recv_conn, time.time())
+
+        for user, (p, conn, t0) in list(running.items()):
+            result = None
+            if conn.poll():
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    logging.warning("user %s: training process died without a result" % (user, ))
+            elif time.time() - t0 > args.budget:
+                logging.warning("user %s: exceeded the time budget of %.1fs, skipping" % (user, args.budget))
+                p.terminate()
+            elif p.is_alive():
+                continue # still training
+            else:
+                logging.warning("user %s: training process exited with code %s" % (user, p.exitcode))
+
+            p.join()
+            conn.close()
+            del running[user]
+            if result is None:
+                nfailed += 1
+                continue
+
+            # store the results right away, so that an interrupted job can resume
+            ixs, scores = result
+            rdb[user] = {
+                'pids': [pids[ix] for ix in ixs],
+                'scores': scores.tolist(),
+                'time': int(time.time()),
+            }
+            ndone += 1
+            logging.info("user %s: stored %d recommendations in %.1fs" % (user, len(ixs), time.time() - t0))
+
+        time.sleep(0.05)
+
+    rdb.close()
+    logging.info("done: %d users updated, %d failed or timed out" % (ndone, nfailed))
@@ -10,23 +10,39 @@ ideas:
 import os
 import re
 import time
+import threading
+import multiprocessing
 from random import shuffle
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
 from sklearn import svm
 
-from flask import Flask, request, redirect, url_for
+from flask import Flask, request, redirect, url_for, jsonify
 from flask import render_template
 from flask import g # global session-level object
 from flask import session
 
-from aslite.db import get_papers_db, get_metas_db, get_tags_db, get_last_active_db, get_email_db
-from aslite.db import load_features
+from aslite.db import get_papers_db, get_metas_db, get_tags_db, get_last_active_db, get_email_db, get_recs_db
+from aslite.db import load_features, features_mtime, load_embeddings, embeddings_version
+from aslite.db import load_suggest_index, suggest_index_version
+from aslite.suggest import suggest
 
 # -----------------------------------------------------------------------------
 # inits and globals
 
 RET_NUM = 25 # number of papers to return per page
+EMBED_NUM = 1000 # number of nearest neighbors returned by the embedding similarity ranking
+
+# the expensive rankings (svm and search) run in a small pool of processes, see run_ranking.
+# NOTE: the pool, the bound and the coalescing are all per server process. Under a server with
+# several worker processes (e.g. gunicorn -w N) there are N pools of RANK_WORKERS processes,
+# up to N * RANK_MAX_PENDING rankings pending, and identical requests that land on different
+# workers are computed twice. Size these with the number of server processes in mind.
+RANK_WORKERS = 2 # number of processes of the pool
+RANK_MAX_PENDING = 8 # max distinct rankings running or queued, beyond that we respond 503
+RANK_DEADLINE = 20.0 # seconds a request waits for its ranking before responding 503
 
 app = Flask(__name__)
 
@@ -54,6 +70,103 @@ def get_metas():
         g._mdb = get_metas_db()
     return g._mdb
 
+# the features are cached in the processes of the rank pool only (see svm_rank), and
+# reloaded whenever compute.py writes new ones. The web workers don't keep a copy:
+# /inspect is rare enough that it loads them per request, as it always did
+_features = {'mtime': None}
+
+def get_features():
+    mtime = features_mtime()
+    if _features['mtime'] != mtime:
+        _features.update(features=load_features(), mtime=mtime)
+    return _features['features']
+
+# the dense embeddings are memory-mapped once per worker process and shared read-only
+# between requests, they are reloaded whenever compute.py writes new ones
+_embeddings = {'version': None}
+
+def get_embeddings():
+    version = embeddings_version()
+    if version is None:
+        return None # compute.py was not run with --embed_dim
+    if _embeddings['version'] != version:
+        e, pids = load_embeddings(version)
+        ptoi = {p: i for i, p in enumerate(pids)}
+        _embeddings.update(e=e, pids=pids, ptoi=ptoi, version=version)
+    return _embeddings
+
+# likewise the typeahead prefix index, which the arxiv daemon rebuilds after every ingest
+_suggest_index = {'version': None}
+
+def get_suggest_index():
+    version = suggest_index_version()
+    if version is None:
+        return None # the index was never built
+    if _suggest_index['version'] != version:
+        _suggest_index.update(index=load_suggest_index(version), version=version)
+    return _suggest_index['index']
+
+# -----------------------------------------------------------------------------
+# execution layer for the expensive rankings. They run in a bounded process pool so
+# that they can't starve the cheap requests of cpu, identical concurrent requests
+# share a single computation, and when too much work is pending we fail fast with a
+# 503 instead of queueing up. Note that this state is per server process (see RANK_*).
+
+class RankingUnavailable(Exception):
+    """ the ranking could not be computed in time, or the pool is saturated """
+
+_rank_pool = None
+_rank_lock = threading.RLock() # reentrant: done callbacks may run inline under the lock
+_rank_inflight = {} # (function name, *args) -> [Future of the computation, number of waiting requests]
+
+def get_rank_pool():
+    global _rank_pool
+    if _rank_pool is None:
+        # spawn rather than fork, forking a multi-threaded server process is unsafe
+        ctx = multiprocessing.get_context('spawn')
+        _rank_pool = ProcessPoolExecutor(max_workers=RANK_WORKERS, mp_context=ctx)
+    return _rank_pool
+
+def run_ranking(fn, *args):
+    """ runs fn(*args) in the rank pool, joining an identical computation if one is in flight """
+    global _rank_pool
+    key = (fn.__name__, ) + args
+    with _rank_lock:
+        entry = _rank_inflight.get(key)
+        if entry is None:
+            if len(_rank_inflight) >= RANK_MAX_PENDING:
+                raise RankingUnavailable("too many rankings pending")
+            try:
+                future = get_rank_pool().submit(fn, *args)
+            except BrokenProcessPool:
+                _rank_pool = None # a worker died, start over with a fresh pool next time
+                raise RankingUnavailable("rank pool is broken")
+            entry = _rank_inflight[key] = [future, 0]
+
+            def forget(f):
+                with _rank_lock:
+                    if key in _rank_inflight and _rank_inflight[key][0] is f:
+                        del _rank_inflight[key]
+            future.add_done_callback(forget)
+        future = entry[0]
+        entry[1] += 1
+
+    try:
+        return future.result(timeout=RANK_DEADLINE)
+    except TimeoutError:
+        raise RankingUnavailable("ranking exceeded the deadline")
+    except BrokenProcessPool:
+        with _rank_lock:
+            _rank_pool = None
+        raise RankingUnavailable("rank pool is broken")
+    finally:
+        # on timeout a computation that already started keeps going, and later identical
+        # requests can still join it. One still queued with nobody left waiting is dropped
+        with _rank_lock:
+            entry[1] -= 1
+            if entry[1] == 0 and not future.done():
+                future.cancel() # only succeeds while queued, forget() then frees its slot
+
 @app.before_request
 def before_request():
     g.user = session.get('user', None)
@@ -120,6 +233,36 @@ def time_rank():
     scores = [(tnow - v['_time'])/60/60/24 for k, v in ms] # time delta in days
     return pids, scores
 
+def recommend_rank():
+    # read the recommendations that the offline recommend.py job precomputed for this user.
+    # NOTE: without the login and tag routes g.user is always None, so this is always empty for now
+    if not g.user:
+        return [], []
+    with get_recs_db(flag='c') as recs_db: # 'c' because the job may not have run yet
+        recs = recs_db.get(g.user, None)
+    if recs is None:
+        return [], []
+    return recs['pids'], recs['scores']
+
+def embed_rank(pid: str = ''):
+    # nearest neighbors of a paper in the dense embedding space
+    if pid is None or pid == '':
+        return [], []
+
+    emb = get_embeddings()
+    if emb is None or pid not in emb['ptoi']:
+        return [], []
+
+    # rows are L2-normalised, so a single mat-vec gives the cosine similarities
+    e = emb['e']
+    s = e @ e[emb['ptoi'][pid]]
+    k = min(EMBED_NUM, len(s))
+    top = np.argpartition(-s, k - 1)[:k]
+    top = top[np.argsort(-s[top])]
+    pids = [emb['pids'][ix] for ix in top]
+    scores = [100 * float(s[ix]) for ix in top]
+    return pids, scores
+
 def svm_rank(pid: str = '', C: float = 0.01):
 
     # tag can be one tag or a few comma-separated tags or 'all' for all tags we have in db
@@ -128,7 +271,7 @@ def svm_rank(pid: str = '', C: float = 0.01):
         return [], [], []
 
     # load all of the features
-    features = load_features()
+    features = get_features()
     x, pids = features['x'], features['pids']
     n, d = x.shape
     ptoi, itop = {}, {}
@@ -177,18 +320,18 @@ def search_rank(q: str = ''):
 
     query_split = sanitized_query.lower().strip().split()  # make lowercase then split query by spaces
 
-    pdb = get_papers()
-
     match = lambda s: sum(min(3, s.lower().count(qp)) for qp in query_split)
     matchu = lambda s: sum(int(s.lower().count(qp) > 0) for qp in query_split)
     pairs = []
-    for pid, p in pdb.items():
-        score = 0.0
-        score += 10.0 * matchu(' '.join([a['name'] if type(a) is dict else a for a in p['authors']])) if p['authors'] else 0.0
-        score += 20.0 * matchu(p['title']) if p['title'] else 0.0
-        score += 1.0 * match(p['summary'])
-        if score > 0:
-            pairs.append((score, pid))
+    # opens its own connection rather than get_papers(), as it runs in the rank pool
+    with get_papers_db() as pdb:
+        for pid, p in pdb.items():
+            score = 0.0
+            score += 10.0 * matchu(' '.join([a['name'] if type(a) is dict else a for a in p['authors']])) if p['authors'] else 0.0
+            score += 20.0 * matchu(p['title']) if p['title'] else 0.0
+            score += 1.0 * match(p['summary'])
+            if score > 0:
+                pairs.append((score, pid))
 
     pairs.sort(reverse=True)
     pids = [p[1] for p in pairs]
@@ -234,7 +377,7 @@ def main():
     default_time_filter = ''
 
     # override variables with any provided options via the interface
-    opt_rank = request.args.get('rank', default_rank) # rank type. search|tags|pid|time|random
+    opt_rank = request.args.get('rank', default_rank) # rank type. search|tags|pid|sim|time|random|recommend
     opt_q = request.args.get('q', '') # search request in the text box
     opt_pid = request.args.get('pid', '')  # pid to find nearest neighbors to
     opt_time_filter = request.args.get('time_filter', default_time_filter) # number of days to filter by
@@ -242,7 +385,7 @@ def main():
     opt_page_number = request.args.get('page_number', '1') # page number for pagination
 
     # only allow valid opt_ranks and default to time
-    if opt_rank not in ["search", "pid", "time", "random"]:
+    if opt_rank not in ["search", "pid", "sim", "time", "random", "recommend"]:
         opt_rank = default_rank
 
     # if a query is given, override rank to be of type "search"
@@ -263,22 +406,33 @@ def main():
 
     # rank papers: by tags, by time, by random
     words = []  # only populated in the case of svm rank
-    if opt_rank == 'search':
-        pids, scores = search_rank(q=opt_q)
+    try:
+        if opt_rank == 'search':
+            pids, scores = run_ranking(search_rank, opt_q)
 
-    elif opt_rank == 'pid':
-        pids, scores, words = svm_rank(pid=opt_pid, C=C)
+        elif opt_rank == 'pid':
+            pids, scores, words = run_ranking(svm_rank, opt_pid, C)
 
-    elif opt_rank == 'time':
-        pids, scores = time_rank()
+        elif opt_rank == 'sim':
+            pids, scores = embed_rank(pid=opt_pid)
 
-    elif opt_rank == 'random':
-        pids, scores = random_rank()
+        elif opt_rank == 'time':
+            pids, scores = time_rank()
 
-    else:
-        # raise ValueError("opt_rank %s is not a thing" % (opt_rank, ))
-        # Invalid rank parameter passed, so render empty index
-        return render_template('index.html', default_context())
+        elif opt_rank == 'random':
+            pids, scores = random_rank()
+
+        elif opt_rank == 'recommend':
+            pids, scores = recommend_rank()
+
+        else:
+            # raise ValueError("opt_rank %s is not a thing" % (opt_rank, ))
+            # Invalid rank parameter passed, so render empty index
+            return render_template('index.html', default_context())
+
+    except RankingUnavailable as e:
+        # back-pressure, the heavy rankings are saturated but the cheap ones keep working
+        return "The server is busy (%s), please try again in a bit." % (e, ), 503, {'Retry-After': '10'}
 
     # filter by time
     if (opt_time_filter is not None) and (opt_time_filter != default_time_filter):
@@ -350,7 +504,7 @@ def inspect():
     if pid not in pdb:
         return "error, malformed pid" # todo: better error handling
 
-    # load the tfidf vectors, the vocab, and the idf table
+    # load the tfidf vectors, the vocab, and the idf table (uncached, see get_features)
     features = load_features()
     x = features['x']
     idf = features['idf']
@@ -374,6 +528,15 @@ def inspect():
     context['words_desc'] = "The following are the tokens and their (tfidf) weight in the paper vector. This is the actual summary that feeds into the SVM to power recommendations, so hopefully it is good and representative!"
     return render_template('inspect.html', **context)
 
+@app.route('/api/suggest', methods=['GET'])
+def api_suggest():
+    # title and author completions for the typeahead of the search box
+    q = request.args.get('q', '')
+    index = get_suggest_index()
+    if index is None or len(q.strip()) < 2:
+        return jsonify({'titles': [], 'authors': []})
+    return jsonify(suggest(index, q))
+
 #@app.route('/profile')
 #def profile():
 #    context = default_context()
@@ -41,3 +41,37 @@ const PaperList = props => {
 
 // render papers into #wrap
 ReactDOM.render(<PaperList papers={papers} />, document.getElementById('wrap'));
+
+// typeahead for the search box: fetch title and author completions once the user stops typing
+const SUGGEST_DELAY_MS = 150;
+let suggest_timer = null;
+let suggest_last_q = '';
+const qfield = document.getElementById('qfield');
+const qfield_suggest = document.getElementById('qfield_suggest');
+if (qfield && qfield_suggest) {
+    qfield.addEventListener('input', () => {
+        clearTimeout(suggest_timer);
+        suggest_timer = setTimeout(() => {
+            const q = qfield.value.trim();
+            if (q.length < 2 || q === suggest_last_q) {
+                return;
+            }
+            suggest_last_q = q;
+            fetch('/api/suggest?q=' + encodeURIComponent(q))
+                .then(resp => resp.json())
+                .then(data => {
+                    if (qfield.value.trim() !== q) {
+                        return; // a newer query is on its way, drop this stale response
+                    }
+                    qfield_suggest.innerHTML = '';
+                    const values = data.titles.map(t => t.title).concat(data.authors.map(a => a.name));
+                    values.forEach(v => {
+                        const opt = document.createElement('option');
+                        opt.value = v;
+                        qfield_suggest.appendChild(opt);
+                    });
+                })
+                .catch(() => {}); // suggestions are best effort
+        }, SUGGEST_DELAY_MS);
+    });
+}